@@ -1,6 +1,11 @@
+import asyncio
+import time
 import httpx
-from typing import List, Optional
-from pydantic import BaseModel, Field
+import orjson
+from cachetools import TTLCache
+from tenacity import RetryCallState, retry, retry_if_exception, wait_exponential_jitter
+from typing import Any, Callable, Coroutine, List, Optional, Set, Tuple
+from pydantic import Field
 
 from nekro_agent.services.plugin.base import NekroPlugin, ConfigBase, SandboxMethodType
 from nekro_agent.api.schemas import AgentCtx
@@ -44,42 +49,213 @@ class AcgImageConfig(ConfigBase):
         title="最大重试次数",
         description="当搜索结果为空时的最大重试次数",
     )
+    CACHE_TTL_SECONDS: int = Field(
+        default=300,
+        ge=1,
+        title="缓存有效期",
+        description="相同标签搜索结果的缓存时间(秒)",
+    )
+    CACHE_MAX_ENTRIES: int = Field(
+        default=128,
+        ge=1,
+        title="最大缓存条目数",
+        description="搜索结果缓存的最大条目数量",
+    )
+    MAX_IMAGE_BYTES: int = Field(
+        default=20 * 1024 * 1024,
+        ge=1,
+        title="最大图片大小",
+        description="允许下载的最大图片字节数，超过则放弃下载",
+    )
+    MAX_CONCURRENCY: int = Field(
+        default=4,
+        ge=1,
+        title="最大并发请求数",
+        description="同时进行的API请求数量上限，避免触发API限流",
+    )
+    RETRY_ATTEMPTS: int = Field(
+        default=3,
+        ge=1,
+        title="网络重试次数",
+        description="网络错误或服务端5xx错误时的最大请求次数",
+    )
+    URL_CACHE_TTL_SECONDS: int = Field(
+        default=3600,
+        ge=1,
+        title="图片URL缓存有效期",
+        description="标签对应图片URL的缓存时间(秒)",
+    )
+    URL_CACHE_REFRESH_SECONDS: int = Field(
+        default=600,
+        ge=1,
+        title="图片URL刷新间隔",
+        description="URL缓存超过该时间(秒)后仍会被使用，但会在后台重新获取",
+    )
 
 # 获取配置
 config = plugin.get_config(AcgImageConfig)
 
-async def fetch_image_data(tags: List[str]) -> Optional[str]:
+# 搜索结果缓存，键为 (R18开关, 排序后的标签元组)
+_image_cache: TTLCache = TTLCache(maxsize=config.CACHE_MAX_ENTRIES, ttl=config.CACHE_TTL_SECONDS)
+
+# 图片URL缓存，值为 (图片URL, 获取该URL所用的标签, 写入时间)，过期前可在后台刷新
+_url_cache: TTLCache = TTLCache(maxsize=config.CACHE_MAX_ENTRIES, ttl=config.URL_CACHE_TTL_SECONDS)
+
+# 最近发起过后台刷新的URL缓存键，每个键在刷新间隔内最多刷新一次
+_refresh_attempts: TTLCache = TTLCache(maxsize=config.CACHE_MAX_ENTRIES, ttl=config.URL_CACHE_REFRESH_SECONDS)
+
+# 共享的HTTP客户端，复用连接池中的长连接
+_client: Optional[httpx.AsyncClient] = None
+
+def _get_client() -> httpx.AsyncClient:
+    """获取共享的HTTP客户端，首次调用时创建
+    
+    Returns:
+        httpx.AsyncClient: 共享的异步HTTP客户端
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=config.TIMEOUT,
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        )
+    return _client
+
+# 全局API并发限制，首次使用时创建以绑定到当前事件循环
+_api_sem: Optional[asyncio.Semaphore] = None
+
+def _get_api_sem() -> asyncio.Semaphore:
+    """获取限制API并发请求数的全局信号量
+    
+    Returns:
+        asyncio.Semaphore: API请求信号量
+    """
+    global _api_sem
+    if _api_sem is None:
+        _api_sem = asyncio.Semaphore(config.MAX_CONCURRENCY)
+    return _api_sem
+
+def _is_transient_network_error(e: BaseException) -> bool:
+    """判断异常是否为可重试的临时性网络错误
+    
+    Args:
+        e: 捕获到的异常
+        
+    Returns:
+        bool: 超时、连接错误或连接被意外断开时返回True
+    """
+    return isinstance(e, (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError))
+
+def _is_transient_download_error(e: BaseException) -> bool:
+    """判断图片下载异常是否为可重试的临时性错误
+    
+    Args:
+        e: 捕获到的异常
+        
+    Returns:
+        bool: 临时性网络错误或CDN返回5xx错误时返回True
+    """
+    if _is_transient_network_error(e):
+        return True
+    return isinstance(e, httpx.HTTPStatusError) and e.response.status_code >= 500
+
+def _stop_after_configured_attempts(retry_state: RetryCallState) -> bool:
+    """判断是否已达到配置的最大请求次数，每次重试时读取最新配置
+    
+    Args:
+        retry_state: 当前重试状态
+        
+    Returns:
+        bool: 达到 RETRY_ATTEMPTS 时返回True
+    """
+    return retry_state.attempt_number >= config.RETRY_ATTEMPTS
+
+def _retry_on(predicate: Callable[[BaseException], bool]) -> Any:
+    """构建临时性错误的指数退避重试装饰器，重试耗尽后抛出原始异常
+    
+    Args:
+        predicate: 判断异常是否可重试的函数
+        
+    Returns:
+        重试装饰器
+    """
+    return retry(
+        retry=retry_if_exception(predicate),
+        wait=wait_exponential_jitter(initial=0.2, max=2.0),
+        stop=_stop_after_configured_attempts,
+        reraise=True,
+    )
+
+# API请求只重试网络错误：各标签组合已并发请求，重试5xx会放大对API的压力
+_retry_api = _retry_on(_is_transient_network_error)
+_retry_download = _retry_on(_is_transient_download_error)
+
+# 请求参数中的固定部分，按R18开关预先构建
+_BASE_PARAMS = {
+    r18_enabled: {"r18": 2 if r18_enabled else 0, "num": 1, "size": "original"}
+    for r18_enabled in (False, True)
+}
+
+@_retry_api
+async def fetch_image_data(
+    tags: List[str],
+    r18_enabled: bool,
+    sem: Optional[asyncio.Semaphore] = None,
+    found: Optional[asyncio.Event] = None,
+) -> Optional[str]:
     """获取图片URL数据
     
+    信号量只在处理请求时持有，重试的退避等待期间不会占用并发名额。
+    
     Args:
         tags: 搜索标签列表
+        r18_enabled: 是否允许R18内容，由调用方传入与缓存键一致的配置快照
+        sem: 额外限制API并发请求数的信号量，可选
+        found: 同一次搜索中已找到图片的标志，已设置时不再发送请求，可选
         
     Returns:
-        str: 图片URL，如果找不到图片则返回None
+        str: 图片URL，如果找不到图片或已由其他请求找到图片则返回None
         
     Raises:
         httpx.RequestError: 请求失败时抛出
         httpx.HTTPStatusError: HTTP状态错误时抛出
-        KeyError: 数据解析错误时抛出
+        orjson.JSONDecodeError: 响应数据解析错误时抛出
     """
-    params = {
-        "r18": 2 if config.R18_ENABLED else 0,
-        "num": 1,
-        "tag": tags,
-        "size": "original"
-    }
-    
-    async with httpx.AsyncClient(timeout=config.TIMEOUT) as client:
-        response = await client.post(config.API_URL, json=params)
+    params = {**_BASE_PARAMS[r18_enabled], "tag": tags}
+    
+    client = _get_client()
+    if sem is not None:
+        await sem.acquire()
+    try:
+        # 先发起的请求优先级更高，其中已有请求找到图片时跳过本次请求
+        if found is not None and found.is_set():
+            return None
+        
+        async with _get_api_sem():
+            response = await client.post(config.API_URL, json=params)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         
-        # 检查是否有返回数据
-        if not data.get("data") or not data["data"]:
+        # 检查是否有返回数据，结构不符合预期时按无结果处理
+        items = data.get("data") if isinstance(data, dict) else None
+        if not isinstance(items, list) or not items or not isinstance(items[0], dict):
+            return None
+        urls = items[0].get("urls")
+        if not isinstance(urls, dict):
             return None
             
-        return data["data"][0]["urls"]["original"]
+        image_url = urls.get("original")
+        if not isinstance(image_url, str):
+            return None
+        if image_url and found is not None:
+            found.set()
+        return image_url
+    finally:
+        if sem is not None:
+            sem.release()
 
+@_retry_download
 async def download_image(url: str) -> Optional[bytes]:
     """下载图片数据并验证内容
     
@@ -92,16 +268,71 @@ async def download_image(url: str) -> Optional[bytes]:
     Raises:
         httpx.RequestError: 请求失败时抛出
         httpx.HTTPStatusError: HTTP状态错误时抛出
+        ValueError: 图片超过大小限制时抛出
     """
-    async with httpx.AsyncClient(timeout=config.TIMEOUT) as client:
-        response = await client.get(url)
+    max_bytes = config.MAX_IMAGE_BYTES
+    client = _get_client()
+    async with client.stream("GET", url) as response:
         response.raise_for_status()
         
-        # 验证图片内容是否有效
-        if not response.content or len(response.content) < 1024:  # 假设小于1KB为无效图片
-            return None
+        size = int(response.headers.get("content-length", 0))
+        if size > max_bytes:
+            raise ValueError(f"图片过大: {size} 字节")
         
-        return response.content
+        buf = bytearray()
+        buf_extend = buf.extend
+        async for chunk in response.aiter_bytes(65536):
+            buf_extend(chunk)
+            if len(buf) > max_bytes:
+                raise ValueError(f"图片过大: 超过 {max_bytes} 字节")
+    
+    # 验证图片内容是否有效
+    if len(buf) < 1024:  # 假设小于1KB为无效图片
+        return None
+    
+    return bytes(buf)
+
+# 图片CDN地址，用于在请求API的同时预热连接
+_CDN_WARMUP_URL = "https://i.pixiv.re/"
+
+# 持有后台任务的引用，避免任务在完成前被回收
+_background_tasks: Set[asyncio.Task] = set()
+
+def _spawn_background(coro: Coroutine[Any, Any, None]) -> None:
+    """在后台运行协程并持有其任务引用
+    
+    Args:
+        coro: 要运行的协程
+    """
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def refresh_url(key: Tuple[bool, Tuple[str, ...]], tags: List[str]) -> None:
+    """在后台重新获取标签对应的图片URL并更新缓存
+    
+    获取失败时保留原有缓存，错误会被忽略。
+    
+    Args:
+        key: URL缓存键，其中的R18开关决定刷新时的请求参数
+        tags: 原URL对应的搜索标签列表
+    """
+    try:
+        image_url = await fetch_image_data(tags, key[0])
+        if image_url:
+            _url_cache[key] = (image_url, tags, time.monotonic())
+    except (httpx.HTTPError, ValueError) as e:
+        logger.debug(f"图片URL后台刷新失败: {str(e)}")
+
+async def warm_up_cdn() -> None:
+    """预热到图片CDN的连接，使TLS握手与API请求并行完成
+    
+    预热失败不影响后续下载，错误会被忽略。
+    """
+    try:
+        await _get_client().head(_CDN_WARMUP_URL, timeout=2.0)
+    except httpx.HTTPError as e:
+        logger.debug(f"CDN连接预热失败: {str(e)}")
 
 def adjust_tags(tags: List[str], attempt: int) -> List[str]:
     """根据重试次数调整标签列表
@@ -144,46 +375,113 @@ async def acg_image_search(_ctx: AgentCtx, tags: List[str]) -> bytes:
         acg_image_search(["初音未来"])
         acg_image_search(["明日方舟", "能天使"])
     """
+    max_tags = config.MAX_TAGS
+    max_retries = config.MAX_RETRIES
+    r18_enabled = config.R18_ENABLED
+    url_refresh_seconds = config.URL_CACHE_REFRESH_SECONDS
+    
     if not tags:
         raise ValueError("至少需要提供一个搜索标签")
-    if len(tags) > config.MAX_TAGS:
-        raise ValueError(f"最多支持{config.MAX_TAGS}个标签同时搜索")
+    if len(tags) > max_tags:
+        raise ValueError(f"最多支持{max_tags}个标签同时搜索")
         
-    clean_tags = [t.strip() for t in tags if t.strip()]
-    last_error = ""
+    clean_tags = [s for s in (t.strip() for t in tags) if s]
+    clean_tags = list(dict.fromkeys(clean_tags))  # 去除重复标签并保持顺序
+    cache_key = (r18_enabled, tuple(sorted(clean_tags)))
+    cached = _image_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"命中图片缓存，标签: {clean_tags}")
+        return cached
     
-    for attempt in range(config.MAX_RETRIES + 1):
-        current_tags = adjust_tags(clean_tags, attempt)
+    # 命中URL缓存时直接下载，缓存较旧则同时在后台刷新
+    cached_url = _url_cache.get(cache_key)
+    if cached_url is not None:
+        image_url, image_tags, inserted_at = cached_url
+        if time.monotonic() - inserted_at > url_refresh_seconds and cache_key not in _refresh_attempts:
+            _refresh_attempts[cache_key] = True
+            _spawn_background(refresh_url(cache_key, image_tags))
         try:
-            # 获取图片URL
-            image_url = await fetch_image_data(current_tags)
-            
-            if not image_url:
-                logger.info(f"未找到匹配图片，尝试 {attempt+1}/{config.MAX_RETRIES}，标签: {current_tags}")
+            image_data = await download_image(image_url)
+        except (httpx.HTTPError, ValueError) as e:
+            image_data = None
+            logger.info(f"缓存的图片URL下载失败，重新搜索: {str(e)}")
+        if image_data:
+            logger.info(f"命中图片URL缓存，标签: {clean_tags}")
+            _image_cache[cache_key] = image_data
+            return image_data
+    
+    # 在请求API的同时预热CDN连接
+    _spawn_background(warm_up_cdn())
+    last_error = ""
+    
+    # 并发发起所有标签组合的搜索，按标签由多到少的优先级依次取结果
+    tag_variants = []
+    for attempt in range(max_retries + 1):
+        variant = adjust_tags(clean_tags, attempt)
+        if variant not in tag_variants:
+            tag_variants.append(variant)
+    api_sem = asyncio.Semaphore(2)  # 限制单次搜索对API的并发请求数
+    found = asyncio.Event()
+    tasks = [asyncio.create_task(fetch_image_data(variant, r18_enabled, api_sem, found)) for variant in tag_variants]
+    
+    image_url = None
+    image_tags = None
+    image_data = None
+    try:
+        for index, (current_tags, task) in enumerate(zip(tag_variants, tasks)):
+            if task.cancelled():
                 continue
+            try:
+                # 获取图片URL
+                image_url = await task
                 
-            # 下载图片
-            image_data = await download_image(image_url) if image_url.startswith("http") else image_url.encode()
-            
-            if not image_data:
-                logger.info(f"下载的图片数据为空，尝试 {attempt+1}/{config.MAX_RETRIES}，标签: {current_tags}")
-                continue
+                if not image_url:
+                    if not found.is_set():
+                        logger.info(f"未找到匹配图片，标签: {current_tags}")
+                    continue
                 
-            return image_data
-            
-        except httpx.RequestError as e:
-            last_error = f"图片搜索请求失败: {str(e)}"
-            logger.error(last_error)
-        except httpx.HTTPStatusError as e:
-            last_error = f"图片搜索HTTP错误: {e.response.status_code}"
-            logger.error(last_error)
-        except KeyError as e:
-            last_error = f"图片数据解析错误: {str(e)}"
-            logger.error(last_error)
-        except Exception as e:
-            last_error = f"图片搜索未知错误: {str(e)}"
+                # 已选定URL，取消尚未完成的低优先级请求，下载失败时只回退到已完成的结果
+                lower_tasks = tasks[index + 1:]
+                for lower_task in lower_tasks:
+                    lower_task.cancel()
+                await asyncio.gather(*lower_tasks, return_exceptions=True)
+                    
+                # 下载图片
+                image_data = await download_image(image_url) if image_url.startswith("http") else image_url.encode()
+                
+                if image_data:
+                    image_tags = current_tags
+                    break
+                logger.info(f"下载的图片数据为空，标签: {current_tags}")
+                
+            except (httpx.HTTPError, ValueError) as e:
+                last_error = f"图片搜索失败: {str(e)}"
+                logger.error(last_error)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # 回收其余任务的结果，避免未处理的异常被事件循环记录
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    if not image_url or not image_data:
+        return (last_error or f"未找到匹配的图片，标签: {clean_tags}").encode()
+    
+    if image_url.startswith("http"):
+        _url_cache[cache_key] = (image_url, image_tags, time.monotonic())
+    _image_cache[cache_key] = image_data
+    return image_data
 
 @plugin.mount_cleanup_method()
 async def clean_up():
     """清理插件资源"""
+    global _client, _api_sem
+    for task in _background_tasks:
+        task.cancel()
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+    _api_sem = None
+    _image_cache.clear()
+    _url_cache.clear()
+    _refresh_attempts.clear()
     logger.info("ACG图片搜索插件资源已清理")